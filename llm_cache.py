@@ -0,0 +1,108 @@
+import hashlib
+import json
+from collections import OrderedDict
+import numpy as np
+
+# Try importing diskcache - fall back to an in-memory dict (cache is lost on restart)
+try:
+    import diskcache
+except ImportError:
+    print("WARNING: diskcache library is not installed. Exact prompt cache will not persist across restarts. Install using: pip install diskcache")
+    diskcache = None
+
+# In-memory fallback for diskcache: same get/[]= interface, evicts the least recently used entry once full
+class MemoryCache:
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self._items = OrderedDict()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, default=None):
+        try:
+            self._items.move_to_end(key)
+        except KeyError:
+            return default
+        return self._items[key]
+
+    def __setitem__(self, key, value):
+        self._items[key] = value
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_entries:
+            self._items.popitem(last=False)
+
+# Open a persistent key/value cache at directory (bounded in-memory LRU of max_entries if diskcache is unavailable;
+# diskcache itself is bounded by its default 1 GB size limit)
+def open_cache(directory, max_entries=1000):
+    if diskcache is None:
+        return MemoryCache(max_entries)
+    return diskcache.Cache(directory)
+
+# Exact-match cache key for a chat completion request
+def prompt_key(model, messages, temperature):
+    payload = json.dumps({"model": model, "messages": messages, "temperature": temperature}, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+# In-process semantic cache for LLM responses.
+# Entries are looked up by cosine similarity of prompt embeddings, so near-duplicate
+# questions ("explain fractions" / "help with fractions please") reuse a stored reply.
+# An optional exact partition key (e.g. a hash of the preceding conversation and model) restricts
+# matches to entries stored under the same key, so only the embedded text is compared fuzzily.
+class LLMCache:
+    def __init__(self, threshold=0.92, max_entries=1000):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self._embeddings = None # (max_entries, dim) array of unit-length embeddings, allocated on first add
+        self._entries = []      # Parallel list of (key, response)
+        self._partitions = []   # Parallel list of partition keys
+        self._last_used = np.zeros(max_entries, dtype=np.int64) # LRU clock per slot
+        self._clock = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    # True if any entry is stored under partition (lets callers skip embedding when nothing can match)
+    def has_partition(self, partition=None):
+        return partition in self._partitions
+
+    # Return the cached response for the closest embedding above the threshold within partition, or None
+    def lookup(self, embedding, partition=None):
+        slots = np.array([slot for slot, entry_partition in enumerate(self._partitions) if entry_partition == partition], dtype=np.int64)
+        if not slots.size:
+            return None
+        query = self._normalize(embedding)
+        # Rows are stored normalized, so the dot product is the cosine similarity
+        similarities = self._embeddings[slots] @ query
+        best = int(np.argmax(similarities))
+        if similarities[best] <= self.threshold:
+            return None
+        slot = int(slots[best])
+        self._touch(slot)
+        return self._entries[slot][1]
+
+    # Store a response; evicts the least recently used entry once the cache is full
+    def add(self, embedding, key, response, partition=None):
+        vector = self._normalize(embedding)
+        if self._embeddings is None:
+            self._embeddings = np.zeros((self.max_entries, vector.shape[0]), dtype=np.float32)
+        if len(self._entries) < self.max_entries:
+            slot = len(self._entries)
+            self._entries.append((key, response))
+            self._partitions.append(partition)
+        else:
+            slot = int(np.argmin(self._last_used))
+            self._entries[slot] = (key, response)
+            self._partitions[slot] = partition
+        self._embeddings[slot] = vector
+        self._touch(slot)
+
+    def _touch(self, slot):
+        self._clock += 1
+        self._last_used[slot] = self._clock
+
+    @staticmethod
+    def _normalize(embedding):
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
@@ -0,0 +1,147 @@
+import re
+import traceback # For better error logging
+from itertools import groupby
+
+# Study guide PDF rendering, run in tutor_app's spawn-started worker processes.
+# Keep this module free of tutor_app/Gradio/OpenAI imports so tasks unpickle cheaply in the workers.
+
+# Try importing fpdf - provide better error message if missing
+try:
+    # Use FPDF class directly from the library
+    from fpdf import FPDF
+except ImportError:
+    print("WARNING: FPDF library is not installed. PDF generation will be disabled. Install using: pip install fpdf2")
+    # Use None to indicate fpdf is not available
+    FPDF = None # Use class name for check later
+
+# Try importing markdown + WeasyPrint for HTML-based PDF rendering (full unicode, CSS styling)
+# WeasyPrint raises OSError when its system libraries (Pango) are missing
+try:
+    import markdown
+    from weasyprint import HTML, CSS, default_url_fetcher
+except (ImportError, OSError):
+    print("WARNING: markdown/weasyprint libraries are not available. Falling back to FPDF for PDF generation. Install using: pip install markdown weasyprint")
+    HTML = None
+
+# Heading styles for the PDF: font style, font size, space before, space after (in line heights)
+PDF_HEADING_STYLES = {
+    "h1": ("B", 16, 1.0, 0.5),
+    "h2": ("B", 14, 0.5, 0.5),
+    "h3": ("BI", 12, 0.5, 0.5), # Bold Italic for H3
+}
+
+# Bullet marker for FPDF list items; must be latin-1 (U+2022 "•" is not) since it is added after the cleanup
+PDF_BULLET = "\u00b7" # Middle dot
+
+# Line classifier for the PDF: heading (# to ###), bullet (- or *), numbered item, or body (empty match)
+PDF_LINE_RE = re.compile(r'^(?P<h>#{1,3}) |^(?P<bul>[-*]) |^(?P<num>\d+)\. |')
+
+# Stylesheet for the WeasyPrint study guide
+PDF_STYLESHEET = """
+@page { size: A4; margin: 15mm; }
+body { font-family: Arial, "DejaVu Sans", sans-serif; font-size: 12pt; line-height: 1.5; }
+h1 { font-size: 16pt; margin: 0 0 6pt; }
+h2 { font-size: 14pt; margin: 12pt 0 4pt; }
+h3 { font-size: 12pt; font-style: italic; margin: 10pt 0 4pt; }
+ul, ol { padding-left: 18pt; }
+table { border-collapse: collapse; }
+th, td { border: 1px solid #999; padding: 2pt 6pt; }
+"""
+
+# URL fetcher for WeasyPrint: the guide is LLM output, so never load local files or remote URLs (only inline data: URLs)
+def data_url_fetcher(url):
+    if url.startswith("data:"):
+        return default_url_fetcher(url)
+    raise ValueError(f"Blocked external resource in study guide: {url[:80]}")
+
+# Markdown renderer with raw HTML disabled, so any tags in the text are escaped and shown literally
+def markdown_to_safe_html(text):
+    md = markdown.Markdown(extensions=['tables', 'sane_lists'])
+    md.preprocessors.deregister('html_block')
+    md.inlinePatterns.deregister('html')
+    return md.convert(text)
+
+# Convert study guide Markdown to PDF via HTML in one pass with WeasyPrint
+def create_pdf_with_weasyprint(study_guide_text, pdf_path):
+    try:
+        html = markdown_to_safe_html(study_guide_text)
+        HTML(string=html, url_fetcher=data_url_fetcher).write_pdf(pdf_path, stylesheets=[CSS(string=PDF_STYLESHEET)])
+        return pdf_path
+    except Exception as e:
+        print(f"Error creating PDF with WeasyPrint: {e}")
+        traceback.print_exc()
+        return None
+
+# Convert study guide text to PDF (WeasyPrint first, FPDF as fallback)
+def create_pdf(study_guide_text, pdf_path):
+    if HTML is not None and create_pdf_with_weasyprint(study_guide_text, pdf_path):
+        return pdf_path
+    return create_pdf_with_fpdf(study_guide_text, pdf_path)
+
+# Convert study guide text (Markdown-like) to PDF with FPDF (latin-1 only; Improved Error Handling)
+def create_pdf_with_fpdf(study_guide_text, pdf_path):
+    if not FPDF: return None
+    try:
+        pdf = FPDF()
+        pdf.add_page()
+        pdf.set_auto_page_break(auto=True, margin=15)
+        pdf.set_font("Arial", "", 12)
+        line_height = 6 # Base line height
+
+        # Core PDF fonts only support latin-1, so drop unsupported characters once up front
+        text = study_guide_text.strip().encode('latin-1', 'ignore').decode('latin-1')
+
+        # 1. Classify every line once into (style, text) with a single regex match per line
+        blocks = []
+        for line in text.split("\n"):
+            line_strip = line.strip()
+            match = PDF_LINE_RE.match(line_strip)
+            kind = match.lastgroup
+            if kind == "h":
+                blocks.append((f"h{len(match.group('h'))}", line_strip[match.end():]))
+            elif kind == "bul":
+                blocks.append(("item", f"{PDF_BULLET} {line_strip[match.end():]}"))
+            elif kind == "num":
+                blocks.append(("item", line_strip))
+            elif line_strip: # Regular text, original line keeps leading spaces if any
+                blocks.append(("body", line))
+            else: # Blank line
+                blocks.append(("blank", ""))
+
+        # 2. Write each run of same-style lines with one font change and one multi_cell call
+        for style, run in groupby(blocks, key=lambda block: block[0]):
+            run_lines = [run_text for _, run_text in run]
+            try:
+                if style == "blank":
+                    pdf.ln(line_height * 0.5 * len(run_lines))
+                elif style in PDF_HEADING_STYLES:
+                    font_style, font_size, space_before, space_after = PDF_HEADING_STYLES[style]
+                    pdf.set_font("Arial", font_style, font_size)
+                    for heading in run_lines: # Headings keep their own spacing
+                        pdf.ln(line_height * space_before)
+                        pdf.multi_cell(0, line_height, heading)
+                        pdf.ln(line_height * space_after)
+                else:
+                    pdf.set_font("Arial", "", 12)
+                    if style == "item":
+                        pdf.set_x(15) # Indent bullet and numbered lists
+                    pdf.multi_cell(0, line_height, "\n".join(run_lines))
+                    pdf.set_x(10)
+
+            except Exception as run_error:
+                 print(f"Skipping PDF block due to error: {run_error} - Text: '{run_lines[0][:50]}...'")
+                 # Optionally add a placeholder in the PDF for skipped blocks
+                 try:
+                     pdf.set_font("Arial", "I", 8)
+                     pdf.set_text_color(255, 0, 0)
+                     pdf.multi_cell(0, line_height, "[Skipped text due to processing error]")
+                     pdf.set_text_color(0, 0, 0)
+                 except: pass # Ignore if error placeholder also fails
+
+        # Save the PDF to the session's file (overwrites the previous guide)
+        pdf.output(pdf_path)
+        return pdf_path
+    except Exception as e:
+        print(f"Error creating PDF: {e}")
+        traceback.print_exc()
+        return None
@@ -1,24 +1,66 @@
 import os
+import re
+import json
+import hashlib
+import asyncio
+import importlib.util
+import numpy as np
 import gradio as gr
-from openai import OpenAI
+import httpx
+from openai import OpenAI, AsyncOpenAI
+import io
+import wave
 import tempfile
+import atexit
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
 import traceback # For better error logging
+from llm_cache import LLMCache, open_cache, prompt_key
+from study_guide_pdf import create_pdf
 
-# Try importing fpdf - provide better error message if missing
+# Try importing faster-whisper for local transcription - fall back to the OpenAI Whisper API if missing
 try:
-    # Use FPDF class directly from the library
-    from fpdf import FPDF
+    from faster_whisper import WhisperModel
 except ImportError:
-    print("WARNING: FPDF library is not installed. PDF generation will be disabled. Install using: pip install fpdf2")
-    # Use None to indicate fpdf is not available
-    FPDF = None # Use class name for check later
+    print("WARNING: faster-whisper library is not installed. Using the OpenAI Whisper API for transcription. Install using: pip install faster-whisper")
+    WhisperModel = None
 
 API_KEY = os.getenv("OPENAI_API_KEY")
 if not API_KEY:
     raise ValueError("API Key not found. Set OPENAI_API_KEY in your environment variables.")
 
-client = OpenAI(api_key=API_KEY)
+# HTTP/2 needs the optional h2 package - fall back to pooled HTTP/1.1 keep-alive connections without it
+HTTP2_ENABLED = importlib.util.find_spec("h2") is not None
+if not HTTP2_ENABLED:
+    print("WARNING: h2 library is not installed. OpenAI calls will use HTTP/1.1. Install using: pip install httpx[http2]")
+
+# Shared connection pools so chat, suggestion and TTS calls reuse warm TLS connections
+HTTP_TIMEOUT = httpx.Timeout(60.0, connect=5.0) # Long study guides are generated without streaming
+HTTP_LIMITS = httpx.Limits(max_keepalive_connections=32, max_connections=64)
+
+client = OpenAI(
+    api_key=API_KEY,
+    http_client=httpx.Client(http2=HTTP2_ENABLED, timeout=HTTP_TIMEOUT, limits=HTTP_LIMITS)
+)
+# Async client for the chat/TTS/suggestion calls made from the async Gradio handlers
+aclient = AsyncOpenAI(
+    api_key=API_KEY,
+    http_client=httpx.AsyncClient(http2=HTTP2_ENABLED, timeout=HTTP_TIMEOUT, limits=HTTP_LIMITS)
+)
+
+# Semantic caches for tutor replies and suggestions (near-duplicate prompts reuse a stored answer)
+EMBEDDING_MODEL = "text-embedding-3-small"
+CACHE_SEED = 1234 # Pinned sampling seed so cached answers stand in for fresh ones at temperature > 0
+tutor_cache = LLMCache(threshold=0.92, max_entries=1000)
+suggestion_cache = LLMCache(threshold=0.92, max_entries=1000)
+# Exact-match cache (sha256 of model + messages + temperature), persisted across restarts and checked first
+exact_cache = open_cache("./.llm_cache")
+# TTS audio cache keyed by sha256 of voice + text, so identical replies (e.g. cached LLM hits) are never re-synthesized
+# (entries are whole MP3 replies, so the in-memory fallback keeps far fewer)
+tts_cache = open_cache("./.tts_cache", max_entries=100)
 
 # --- Prompts (kept exactly as in your original code) ---
 SYSTEM_PROMPT = """
@@ -68,6 +110,32 @@ Example responses might include:
 - Sharing progress: "I tried solving it and got x = 7. Is that right?"
 """
 
+# Appended to SYSTEM_PROMPT so one JSON-mode call returns the tutor reply and the suggested student responses
+TUTOR_RESPONSE_FORMAT_PROMPT = """
+Response Format:
+Always answer with a JSON object with exactly these keys, in this order:
+- "reply": your message to the student, as plain text.
+- "suggestions": a list of 3 different things the student might say next. Make them:
+  1. Show different levels of understanding (basic, intermediate, curious/advanced)
+  2. Be brief (1-3 sentences each) and natural, as a student would actually speak
+  3. Include specific follow-up questions, or partial understanding/confusion that shows the tutor where to focus
+"""
+
+TUTOR_SYSTEM_PROMPT = SYSTEM_PROMPT + TUTOR_RESPONSE_FORMAT_PROMPT
+
+HISTORY_SUMMARY_PROMPT = """
+You summarize the earlier part of a tutoring session between a STEM tutor and a K–12 student.
+
+You may be given the summary so far followed by new turns; update that summary with the new turns.
+
+In a short paragraph, capture:
+- The topics covered and what the student has already mastered.
+- Where the student struggled or was confused.
+- Any open question, exercise, or next step the tutor proposed.
+
+Output only the summary.
+"""
+
 SUMMARY_SYSTEM_PROMPT = """
 You are a world‑class AI study‑guide generator. Transform the entire tutoring conversation into a professional, PDF‑ready study guide.
 
@@ -96,18 +164,64 @@ Begin output with:
 
 # --- Core Functions (with functional fixes) ---
 
-# Transcribe audio to text (Simplified)
-def transcribe_audio(audio_filepath):
-    if audio_filepath is None:
+# Local Whisper model (CTranslate2 INT8 on CPU), loaded on first use and shared by all sessions
+LOCAL_WHISPER_SIZE = "small"
+_local_whisper = None
+_local_whisper_lock = threading.Lock()
+
+def get_local_whisper():
+    global _local_whisper
+    if WhisperModel is None:
+        return None
+    with _local_whisper_lock:
+        if _local_whisper is None:
+            _local_whisper = WhisperModel(LOCAL_WHISPER_SIZE, device="cpu", compute_type="int8")
+    return _local_whisper
+
+# Encode Gradio's numpy audio (sample_rate, samples) as in-memory 16-bit WAV bytes
+def audio_to_wav_bytes(audio):
+    sample_rate, samples = audio
+    samples = np.asarray(samples)
+    if np.issubdtype(samples.dtype, np.floating):
+        samples = (np.clip(samples, -1.0, 1.0) * 32767).astype(np.int16)
+    elif samples.dtype != np.int16:
+        samples = (samples / np.iinfo(samples.dtype).max * 32767).astype(np.int16)
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav_file:
+        wav_file.setnchannels(1 if samples.ndim == 1 else samples.shape[1])
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(sample_rate)
+        wav_file.writeframes(samples.tobytes())
+    return buffer.getvalue()
+
+# Transcribe audio locally with faster-whisper (returns None so the caller can fall back to the API)
+def transcribe_audio_locally(wav_bytes):
+    try:
+        model = get_local_whisper()
+        if model is None:
+            return None
+        segments, _ = model.transcribe(io.BytesIO(wav_bytes), beam_size=1, vad_filter=True)
+        return "".join(segment.text for segment in segments).strip()
+    except Exception as e:
+        print(f"Error transcribing audio locally, falling back to the API: {e}")
+        traceback.print_exc()
+        return None
+
+# Transcribe audio to text (local model first, OpenAI API as fallback)
+def transcribe_audio(audio):
+    if audio is None:
         return "" # Return empty string if no audio
     try:
-        # audio_filepath is the path provided by Gradio's Audio component type="filepath"
-        with open(audio_filepath, "rb") as audio_file:
-            transcription = client.audio.transcriptions.create(
-                model="whisper-1",
-                file=audio_file
-            )
-        # Gradio manages the temp file from the Audio component
+        # audio is the (sample_rate, samples) tuple from Gradio's Audio component type="numpy";
+        # it is encoded in memory so nothing is re-read from disk
+        wav_bytes = audio_to_wav_bytes(audio)
+        local_text = transcribe_audio_locally(wav_bytes)
+        if local_text is not None:
+            return local_text
+        transcription = client.audio.transcriptions.create(
+            model="whisper-1",
+            file=("audio.wav", wav_bytes)
+        )
         return transcription.text
     except Exception as e:
         print(f"Error transcribing audio: {e}")
@@ -115,61 +229,310 @@ def transcribe_audio(audio_filepath):
         # Return error message to be displayed in chat
         return f"Error transcribing audio: {str(e)}"
 
-# Generate speech from text (Using tempfile)
-def generate_speech(text, voice="nova"):
+# Cache key for synthesized speech
+def speech_key(text, voice):
+    return hashlib.sha256(f"{voice}\n{text}".encode("utf-8")).hexdigest()
+
+# Generate speech from text (streamed, yields MP3 byte chunks as soon as the API sends them)
+async def generate_speech(text, voice="nova"):
+    key = speech_key(text, voice)
+    cached_audio = tts_cache.get(key)
+    if cached_audio:
+        yield cached_audio
+        return
     try:
-        # Use a temporary file for the speech output
-        with tempfile.NamedTemporaryFile(suffix=".mp3", delete=False) as tmp_speech_file:
-            speech_file_path = tmp_speech_file.name
-
-        response = client.audio.speech.create(
+        audio_chunks = []
+        async with aclient.audio.speech.with_streaming_response.create(
             model="tts-1",
             voice=voice, # alloy, echo, fable, onyx, nova, shimmer
-            input=text
-        )
-        response.stream_to_file(speech_file_path)
-        return speech_file_path
+            input=text,
+            response_format="mp3" # Gradio's streaming audio player plays MP3 chunks
+        ) as response:
+            async for audio_chunk in response.iter_bytes(chunk_size=4096):
+                audio_chunks.append(audio_chunk)
+                yield audio_chunk
+        tts_cache[key] = b"".join(audio_chunks)
     except Exception as e:
         print(f"Error generating speech: {e}")
         traceback.print_exc()
+
+# Embed text for the semantic caches (returns None on failure so callers just skip the cache)
+async def embed_text(text):
+    try:
+        response = await aclient.embeddings.create(model=EMBEDDING_MODEL, input=text)
+        return response.data[0].embedding
+    except Exception as e:
+        print(f"Error creating embedding: {e}")
+        traceback.print_exc()
+        return None
+
+# Model routing: most turns go to the fast, cheap model; complex math or signs of confusion escalate
+TUTOR_MODEL = "gpt-4o-mini"
+ESCALATION_MODEL = "gpt-4o"
+ESCALATION_RE = re.compile(
+    r"\b(integrals?|derivatives?|calculus|prove|proofs?|why does|explain deeper|don'?t understand|still lost)\b|\bconfus",
+    re.IGNORECASE
+)
+
+def choose_tutor_model(user_input):
+    return ESCALATION_MODEL if ESCALATION_RE.search(user_input) else TUTOR_MODEL
+
+# History truncation: keep at least the last HISTORY_KEEP_TURNS turns verbatim and fold older turns
+# into a rolling summary. The cut point moves in steps of HISTORY_SUMMARY_STEP turns; each step updates
+# the previous summary with only the newly folded turns, so summary input stays bounded.
+HISTORY_KEEP_TURNS = 8
+HISTORY_SUMMARY_STEP = 4
+# In-flight summary tasks by summary key, shared by the background prefetch and the next turn
+_pending_summaries = {}
+
+# Number of leading turn messages folded into the summary for a session with turn_count turns
+def summary_cut(turn_count):
+    if turn_count <= HISTORY_KEEP_TURNS:
+        return 0
+    # Turns are recorded as user/assistant pairs, so two messages per turn
+    return (turn_count - HISTORY_KEEP_TURNS) // HISTORY_SUMMARY_STEP * HISTORY_SUMMARY_STEP * 2
+
+# Cache key for the summary covering exactly folded_messages
+def summary_key(folded_messages):
+    return "history-summary:" + prompt_key("summary", folded_messages, None)
+
+# Summarize turn messages with the cheap model, updating previous_summary if given
+# (returns None on failure so the turns are just dropped)
+async def summarize_history(turn_messages, previous_summary=None):
+    speakers = {"user": "STUDENT", "assistant": "TUTOR"}
+    transcript = "\n\n".join(f"{speakers[message['role']]}: {message['content']}" for message in turn_messages)
+    if previous_summary:
+        transcript = f"SUMMARY SO FAR:\n{previous_summary}\n\nNEW TURNS:\n{transcript}"
+    messages = [
+        {"role": "system", "content": HISTORY_SUMMARY_PROMPT},
+        {"role": "user", "content": transcript}
+    ]
+    try:
+        completion = await aclient.chat.completions.create(
+            model="gpt-4o-mini",
+            messages=messages,
+            max_tokens=300,
+            temperature=0.3,
+            seed=CACHE_SEED
+        )
+        return completion.choices[0].message.content
+    except Exception as e:
+        print(f"Error summarizing history: {e}")
+        traceback.print_exc()
         return None
 
-# Get AI tutor response
-def ai_tutor(user_input, history):
-    messages = [{"role": "system", "content": SYSTEM_PROMPT}]
-    for human, ai in history:
-        if human: messages.append({"role": "user", "content": human})
-        if ai: messages.append({"role": "assistant", "content": ai})
+# Build the summary for folded_messages from the previous step's summary plus the newly folded turns
+async def build_history_summary(folded_messages):
+    previous_cut = len(folded_messages) - HISTORY_SUMMARY_STEP * 2
+    previous_summary = exact_cache.get(summary_key(folded_messages[:previous_cut])) if previous_cut > 0 else None
+    if previous_summary:
+        summary = await summarize_history(folded_messages[previous_cut:], previous_summary)
+    else: # First fold, or the previous summary is unavailable: summarize the whole prefix once
+        summary = await summarize_history(folded_messages)
+    if summary:
+        exact_cache[summary_key(folded_messages)] = summary
+    return summary
+
+# Start (or join) the summary task for folded_messages
+def history_summary_task(folded_messages):
+    key = summary_key(folded_messages)
+    task = _pending_summaries.get(key)
+    if task is None:
+        task = asyncio.create_task(build_history_summary(list(folded_messages)))
+        _pending_summaries[key] = task
+        task.add_done_callback(lambda _: _pending_summaries.pop(key, None))
+    return task
+
+# Get the summary for folded_messages from the cache, an in-flight task, or a new call
+async def history_summary(folded_messages):
+    cached_summary = exact_cache.get(summary_key(folded_messages))
+    if cached_summary:
+        return cached_summary
+    # Shielded so a cancelled turn doesn't cancel a summary that other turns may be waiting on
+    return await asyncio.shield(history_summary_task(folded_messages))
+
+# After a turn, start the summary the next turn will need in the background so it doesn't delay the stream
+def prefetch_history_summary(messages):
+    cut = summary_cut(len(messages) // 2)
+    if cut and exact_cache.get(summary_key(messages[:cut])) is None:
+        history_summary_task(messages[:cut])
+
+# Extract the (possibly still incomplete) "reply" string from a partially streamed JSON object
+REPLY_START_RE = re.compile(r'"reply"\s*:\s*"')
+JSON_ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+
+def partial_reply_text(raw):
+    match = REPLY_START_RE.search(raw)
+    if not match:
+        return ""
+    chars = []
+    i = match.end()
+    while i < len(raw):
+        ch = raw[i]
+        if ch == '"': # End of the reply string
+            break
+        if ch == '\\':
+            escape = raw[i + 1:i + 2]
+            if not escape: # Escape sequence split across chunks
+                break
+            if escape == 'u':
+                hex_digits = raw[i + 2:i + 6]
+                if len(hex_digits) < 4:
+                    break
+                chars.append(chr(int(hex_digits, 16)))
+                i += 6
+                continue
+            chars.append(JSON_ESCAPES.get(escape, escape))
+            i += 2
+            continue
+        chars.append(ch)
+        i += 1
+    # Join \uXXXX surrogate pairs (e.g. emoji) and drop a half pair cut off by the chunk boundary
+    return "".join(chars).encode("utf-16", "surrogatepass").decode("utf-16", "ignore")
+
+# Parse the final JSON payload into (reply, suggestions); suggestions is None if they are missing
+def parse_tutor_response(raw):
+    try:
+        payload = json.loads(raw)
+    except ValueError:
+        return partial_reply_text(raw) or raw, None
+    if not isinstance(payload, dict):
+        return raw, None
+    reply = str(payload.get("reply") or "")
+    if not reply.strip(): # Missing/null reply: treat like malformed JSON rather than show an empty bubble
+        return partial_reply_text(raw) or raw, None
+    suggestions = payload.get("suggestions")
+    if not isinstance(suggestions, list):
+        return reply, None
+    suggestions = [str(item).strip() for item in suggestions if str(item).strip()][:3]
+    return reply, (suggestions or None)
+
+# OpenAI caches prompt prefixes whose bytes are identical across requests, so every tutor prompt is
+# ordered [static system prompt, rolling summary, recent turns, current input]. The system message is
+# a module constant (never stored per session or mutated), and anything dynamic goes after it.
+TUTOR_SYSTEM_MESSAGE = {"role": "system", "content": TUTOR_SYSTEM_PROMPT}
+PROMPT_CACHE_KEY = "stem-tutor" # Routes tutor requests sharing the prefix to the same prompt cache
+
+# Initial session message list (kept in gr.State and extended by one user/assistant pair per turn)
+def new_session_messages():
+    return []
+
+# Record a completed turn in the session message list
+def record_turn(messages, user_input, reply):
     messages.append({"role": "user", "content": user_input})
+    messages.append({"role": "assistant", "content": reply})
+    prefetch_history_summary(messages)
+
+# Get AI tutor response (streamed, yields (reply_so_far, suggestions) as chunks arrive;
+# suggestions is None until the final yield, and stays None if the model did not provide them).
+# messages is the session's list of turn messages; the turn is appended to it once the reply is complete.
+async def ai_tutor(user_input, messages):
+    turn_messages = messages
+    prompt = [TUTOR_SYSTEM_MESSAGE]
+    cut = summary_cut(len(turn_messages) // 2)
+    if cut:
+        # Usually already cached by the background prefetch after the previous turn
+        summary = await history_summary(turn_messages[:cut])
+        if summary: # Injected after the static system prompt so the cached prefix is preserved
+            prompt.append({"role": "system", "content": f"Prior conversation summary: {summary}"})
+            turn_messages = turn_messages[cut:]
+        # Otherwise (summary call failed) send the full history this turn rather than dropping the older turns
+    prompt.extend(turn_messages)
+    prompt.append({"role": "user", "content": user_input})
+
+    # Exact repeats (e.g. the example questions) skip both the embedding and the completion
+    model, temperature = choose_tutor_model(user_input), 0.7
+    exact_key = prompt_key(model, prompt, temperature)
+    cached_response = exact_cache.get(exact_key)
+    if cached_response:
+        record_turn(messages, user_input, cached_response[0])
+        yield cached_response
+        return
+
+    # Semantic lookup: only the student's input is compared by embedding; everything before it
+    # (system prompt, summary, earlier turns) and the model must match exactly via the partition key,
+    # so different answers to the same tutor question never share a reply
+    cache_key = user_input
+    cache_partition = prompt_key(model, prompt[:-1], temperature)
+    embedding, embedding_task = None, None
+    if tutor_cache.has_partition(cache_partition):
+        embedding = await embed_text(cache_key)
+        if embedding is not None:
+            cached_response = tutor_cache.lookup(embedding, cache_partition)
+            if cached_response:
+                record_turn(messages, user_input, cached_response[0])
+                yield cached_response
+                return
+    else:
+        # Nothing stored for this context (usual after the first turn): don't delay the first token,
+        # embed alongside the stream only so the reply can be stored
+        embedding_task = asyncio.create_task(embed_text(cache_key))
 
     try:
-        completion = client.chat.completions.create(
-            model="gpt-4o", # Or gpt-4, gpt-3.5-turbo
-            messages=messages,
-            max_tokens=500,
-            temperature=0.7
+        stream = await aclient.chat.completions.create(
+            model=model,
+            messages=prompt,
+            max_tokens=650, # Reply plus three short suggestions
+            temperature=temperature,
+            seed=CACHE_SEED,
+            response_format={"type": "json_object"},
+            extra_body={"prompt_cache_key": PROMPT_CACHE_KEY},
+            stream=True
         )
-        reply = completion.choices[0].message.content
-        return reply
+        raw = ""
+        reply = ""
+        async for chunk in stream:
+            # Some chunks (e.g. the final one) carry no choices or an empty delta
+            if chunk.choices and chunk.choices[0].delta.content:
+                raw += chunk.choices[0].delta.content
+                partial = partial_reply_text(raw)
+                if partial != reply: # Chunks after the reply (the suggestions) don't change the chat
+                    reply = partial
+                    yield reply, None
+        reply, suggestions = parse_tutor_response(raw)
+        if reply:
+            record_turn(messages, user_input, reply)
+        yield reply, suggestions
+        if reply:
+            exact_cache[exact_key] = (reply, suggestions)
+            if embedding_task is not None:
+                embedding = await embedding_task
+            if embedding is not None:
+                tutor_cache.add(embedding, cache_key, (reply, suggestions), cache_partition)
     except Exception as e:
         print(f"Error getting AI completion: {e}")
         traceback.print_exc()
-        return f"Error: {str(e)}\n\nPlease check your API key/quota and connection."
+        yield f"Error: {str(e)}\n\nPlease check your API key/quota and connection.", None
+    finally:
+        # Unused on error/cancel
+        if embedding_task is not None and not embedding_task.done():
+            embedding_task.cancel()
 
 # Generate suggested student responses based on tutor's message
-def generate_suggested_responses(tutor_message):
+async def generate_suggested_responses(tutor_message):
     if not tutor_message or tutor_message.startswith("Error"):
         return []
     messages = [
         {"role": "system", "content": SUGGESTED_RESPONSES_PROMPT},
         {"role": "user", "content": f"Generate 3 student response suggestions for this tutor message:\n\n{tutor_message}"}
     ]
+    model, temperature = "gpt-4o-mini", 0.8 # Cheaper model
+    exact_key = prompt_key(model, messages, temperature)
+    cached_suggestions = exact_cache.get(exact_key)
+    if cached_suggestions:
+        return list(cached_suggestions)
+    embedding = await embed_text(tutor_message)
+    if embedding is not None:
+        cached_suggestions = suggestion_cache.lookup(embedding)
+        if cached_suggestions:
+            return list(cached_suggestions)
     try:
-        completion = client.chat.completions.create(
-            model="gpt-4o-mini", # Cheaper model
+        completion = await aclient.chat.completions.create(
+            model=model,
             messages=messages,
             max_tokens=150,
-            temperature=0.8
+            temperature=temperature,
+            seed=CACHE_SEED
         )
         suggestions_text = completion.choices[0].message.content
         suggestions = []
@@ -182,7 +545,12 @@ def generate_suggested_responses(tutor_message):
                     suggestions.append(parts[1].strip())
         if not suggestions and len(lines) >= 1:
             suggestions = [line.strip() for line in lines if line.strip()][:3]
-        return suggestions[:3]
+        suggestions = suggestions[:3]
+        if suggestions:
+            exact_cache[exact_key] = suggestions
+            if embedding is not None:
+                suggestion_cache.add(embedding, tutor_message, suggestions)
+        return suggestions
     except Exception as e:
         print(f"Error generating suggestions: {e}")
         traceback.print_exc()
@@ -193,11 +561,12 @@ def generate_study_guide_content(chat_history):
     if not chat_history:
         return "No conversation history to create a study guide from."
     messages = [{"role": "system", "content": SUMMARY_SYSTEM_PROMPT}]
-    conversation_text = "### TUTORING SESSION TRANSCRIPT ###\n\n"
+    # Build the transcript as a list and join once (repeated += copies the whole string each turn)
+    parts = ["Please create a concise study guide based on this tutoring conversation:", "### TUTORING SESSION TRANSCRIPT ###"]
     for human, ai in chat_history:
-        conversation_text += f"STUDENT: {human}\n\n"
-        if ai: conversation_text += f"TUTOR: {ai}\n\n"
-    messages.append({"role": "user", "content": f"Please create a concise study guide based on this tutoring conversation:\n\n{conversation_text}"})
+        parts.append(f"STUDENT: {human}")
+        if ai: parts.append(f"TUTOR: {ai}")
+    messages.append({"role": "user", "content": "\n\n".join(parts)})
 
     try:
         completion = client.chat.completions.create(
@@ -216,10 +585,9 @@ def generate_study_guide_content(chat_history):
         return f"Error generating study guide: {str(e)}"
 
 # Create a text file version of the study guide
-def create_text_file(study_guide_text):
+def create_text_file(study_guide_text, file_path):
     try:
-        with tempfile.NamedTemporaryFile(mode='w', delete=False, suffix=".txt", encoding='utf-8') as temp_file:
-            file_path = temp_file.name
+        with open(file_path, 'w', encoding='utf-8') as temp_file: # Truncates the session's previous guide
             temp_file.write("STEM TUTOR - STUDY GUIDE\n")
             temp_file.write("=" * 30 + "\n\n")
             temp_file.write(study_guide_text)
@@ -231,91 +599,63 @@ def create_text_file(study_guide_text):
         traceback.print_exc()
         return None
 
-# Convert study guide text (Markdown-like) to PDF (Improved Error Handling)
-def create_pdf(study_guide_text):
-    if not FPDF: return None
+# Remove a session file at exit (ignore files that are already gone)
+def remove_file(path):
     try:
-        pdf = FPDF()
-        pdf.add_page()
-        pdf.set_auto_page_break(auto=True, margin=15)
-        pdf.set_font("Arial", "", 12)
-        line_height = 6 # Base line height
-
-        lines = study_guide_text.strip().split("\n")
-
-        # Simplified processing loop with error handling per line
-        for line in lines:
-            try:
-                # Attempt to encode with latin-1, skip if fails (common PDF limitation)
-                line.encode('latin-1', 'ignore') # Ignore problematic chars
-
-                line_strip = line.strip()
-                if line.startswith("# "):
-                    pdf.set_font("Arial", "B", 16)
-                    pdf.ln(line_height)
-                    pdf.multi_cell(0, line_height, line_strip[2:])
-                    pdf.ln(line_height * 0.5)
-                elif line.startswith("## "):
-                    pdf.set_font("Arial", "B", 14)
-                    pdf.ln(line_height * 0.5)
-                    pdf.multi_cell(0, line_height, line_strip[3:])
-                    pdf.ln(line_height * 0.5)
-                elif line.startswith("### "):
-                    pdf.set_font("Arial", "BI", 12) # Bold Italic for H3
-                    pdf.ln(line_height * 0.5)
-                    pdf.multi_cell(0, line_height, line_strip[4:])
-                    pdf.ln(line_height * 0.5)
-                elif line_strip.startswith(("- ", "* ")):
-                    pdf.set_font("Arial", "", 12)
-                    pdf.set_x(15)
-                    pdf.cell(5, line_height, "•", ln=0)
-                    pdf.multi_cell(0, line_height, line_strip[2:])
-                    pdf.set_x(10)
-                elif line_strip and line_strip[0].isdigit() and ". " in line_strip:
-                     parts = line_strip.split(". ", 1)
-                     if len(parts) == 2 and parts[0].isdigit():
-                         pdf.set_font("Arial", "", 12)
-                         pdf.set_x(15)
-                         pdf.cell(5, line_height, f"{parts[0]}.", ln=0)
-                         pdf.multi_cell(0, line_height, parts[1])
-                         pdf.set_x(10)
-                     else: # Treat as regular text if not a standard numbered list item
-                         pdf.set_font("Arial", "", 12)
-                         pdf.multi_cell(0, line_height, line)
-                elif line_strip: # Regular text
-                    pdf.set_font("Arial", "", 12)
-                    pdf.multi_cell(0, line_height, line) # Use original line to preserve leading spaces if any
-                else: # Blank line
-                    pdf.ln(line_height * 0.5)
-
-            except Exception as line_error:
-                 print(f"Skipping PDF line due to error: {line_error} - Line: '{line_strip[:50]}...'")
-                 # Optionally add a placeholder in the PDF for skipped lines
-                 try:
-                     pdf.set_font("Arial", "I", 8)
-                     pdf.set_text_color(255, 0, 0)
-                     pdf.multi_cell(0, line_height, "[Skipped line due to processing error]")
-                     pdf.set_text_color(0, 0, 0)
-                 except: pass # Ignore if error placeholder also fails
-
-        # Save the PDF to a temporary file
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as temp_file:
-            pdf_path = temp_file.name
-            pdf.output(pdf_path)
-        return pdf_path
-    except Exception as e:
-        print(f"Error creating PDF: {e}")
-        traceback.print_exc()
-        return None
+        os.unlink(path)
+    except OSError:
+        pass
+
+# Get the session's reusable output file for a suffix, creating it on first use.
+# session_files is the per-session dict held in gr.State, so repeated guides overwrite
+# one file instead of leaking a new temp file per click.
+def session_file_path(session_files, suffix):
+    if suffix not in session_files:
+        fd, path = tempfile.mkstemp(suffix=suffix)
+        os.close(fd)
+        atexit.register(remove_file, path)
+        session_files[suffix] = path
+    return session_files[suffix]
+
+# Worker processes for PDF rendering (CPU-bound), so long guides don't block the event loop or other users.
+# Workers start on first use and stay warm for later guides. "spawn" avoids forking the multi-threaded
+# server, but each spawned worker re-runs this script as __mp_main__ (importing gradio/openai/faster-whisper,
+# opening the disk caches and building the UI; only demo.launch() is skipped) and keeps that memory while it lives.
+# create_pdf itself comes from study_guide_pdf, so the submitted tasks stay small.
+def new_pdf_pool():
+    return ProcessPoolExecutor(max_workers=2, mp_context=multiprocessing.get_context("spawn"))
+
+PDF_POOL = new_pdf_pool()
+
+# Render the PDF in the worker pool. One crashed worker (e.g. out of memory) breaks the whole pool,
+# so replace it with a fresh pool and retry once instead of failing every later guide.
+async def render_pdf(study_guide_text, pdf_path):
+    global PDF_POOL
+    for attempt in range(2):
+        pool = PDF_POOL
+        try:
+            return await asyncio.get_running_loop().run_in_executor(pool, create_pdf, study_guide_text, pdf_path)
+        except BrokenProcessPool:
+            if attempt:
+                raise
+            print("PDF worker pool is broken (a worker process died). Starting a new pool and retrying.")
+            if PDF_POOL is pool: # A concurrent request may already have replaced it
+                PDF_POOL = new_pdf_pool()
+                pool.shutdown(wait=False)
 
 # Function to save the study guide (tries PDF first, falls back to text)
-def save_study_guide(study_guide_text):
-    pdf_path = create_pdf(study_guide_text)
+async def save_study_guide(study_guide_text, session_files):
+    try:
+        pdf_path = await render_pdf(study_guide_text, session_file_path(session_files, ".pdf"))
+    except Exception as e: # e.g. the pool broke again on retry
+        print(f"Error rendering PDF in worker process: {e}")
+        traceback.print_exc()
+        pdf_path = None
     if pdf_path:
         return pdf_path, "Study guide created as PDF!"
     else:
         print("Falling back to text file for study guide.")
-        text_path = create_text_file(study_guide_text)
+        text_path = await asyncio.to_thread(create_text_file, study_guide_text, session_file_path(session_files, ".txt"))
         if text_path:
             return text_path, "Study guide created as Text (PDF failed)."
         else:
@@ -323,6 +663,15 @@ def save_study_guide(study_guide_text):
 
 # --- Gradio Specific Functions (Updated Logic) ---
 
+# Speak the latest tutor reply on demand (used when voice output is turned off)
+async def play_last_reply(chat_history):
+    bot_message = chat_history[-1][1] if chat_history else None
+    if not bot_message or bot_message.startswith("Error"):
+        yield None
+        return
+    async for audio_chunk in generate_speech(bot_message):
+        yield audio_chunk
+
 # Use a suggestion in the text input
 def use_suggestion(suggestion):
     # When a suggestion button is clicked, its value is passed as 'suggestion'
@@ -341,77 +690,94 @@ def update_suggestions(suggestions):
     # Return the update objects for the 3 buttons
     return updates[0], updates[1], updates[2]
 
-# Combined function to process text input, get response, generate audio/suggestions, and update UI
-def process_text_and_update(message, chat_history, voice_enabled):
+# Stream TTS audio and show suggestions as soon as they are ready (generated here only if the
+# tutor call didn't return them, concurrently with TTS).
+# Yields (audio_chunk, suggestion_button_updates); None means "leave that output unchanged".
+async def speech_and_suggestions(bot_message, voice_enabled, suggestions=None):
+    suggestions_task = None
+    if suggestions is None:
+        suggestions_task = asyncio.create_task(generate_suggested_responses(bot_message))
+    else:
+        yield None, update_suggestions(suggestions)
+
+    if voice_enabled and bot_message and not bot_message.startswith("Error"):
+        async for audio_chunk in generate_speech(bot_message):
+            if suggestions_task is not None and suggestions_task.done():
+                yield audio_chunk, update_suggestions(suggestions_task.result())
+                suggestions_task = None
+            else:
+                yield audio_chunk, None
+
+    if suggestions_task is not None:
+        yield None, update_suggestions(await suggestions_task)
+
+# Combined function to process text input, stream the response, generate audio/suggestions, and update UI
+async def process_text_and_update(message, chat_history, voice_enabled, messages):
     if not message.strip(): # Ignore empty messages
         s1, s2, s3 = update_suggestions([]) # Clear suggestions if input is cleared
-        # Return updates: clear msg, keep history, no audio, clear suggestions
-        return "", chat_history, None, s1, s2, s3
-
-    # 1. Get AI response
-    bot_message = ai_tutor(message, chat_history)
-    # 2. Update history
-    chat_history.append((message, bot_message))
-    # 3. Generate audio (if enabled and no error)
-    audio_output_path = None
-    if voice_enabled and not bot_message.startswith("Error"):
-        audio_output_path = generate_speech(bot_message)
-    # 4. Generate suggestions (based on valid bot message)
-    suggestions = generate_suggested_responses(bot_message)
-    # 5. Get suggestion button updates
-    s1_update, s2_update, s3_update = update_suggestions(suggestions)
-    # 6. Return all updates for Gradio outputs
-    #    Clear msg, update chatbot, update audio_output, update 3 suggestion buttons
-    return "", chat_history, audio_output_path, s1_update, s2_update, s3_update
-
-# Combined function to process audio input, get response, generate audio/suggestions, and update UI
-def process_audio_and_update(audio_filepath, chat_history, voice_enabled):
-    if audio_filepath is None: # No audio input provided
-        s1, s2, s3 = update_suggestions([])
-        # Return updates: clear audio_input, keep history, no audio output, clear suggestions
-        return None, chat_history, None, s1, s2, s3
-
-    # 1. Transcribe Audio
-    user_text = transcribe_audio(audio_filepath)
+        # Yield updates: clear msg, keep history, no audio, clear suggestions, keep session messages
+        yield "", chat_history, None, s1, s2, s3, messages
+        return
+
+    # 1. Add the user turn with an empty reply, then stream the AI response into it
+    chat_history.append((message, ""))
+    bot_message, suggestions = "", None
+    async for bot_message, suggestions in ai_tutor(message, messages):
+        chat_history[-1] = (message, bot_message)
+        # Clear msg, update chatbot, leave audio and suggestion buttons untouched
+        yield "", chat_history, None, gr.update(), gr.update(), gr.update(), messages
+    # 2. Stream audio (if enabled and no error) and show suggestions
+    async for audio_chunk, suggestion_updates in speech_and_suggestions(bot_message, voice_enabled, suggestions):
+        s1_update, s2_update, s3_update = suggestion_updates or (gr.update(), gr.update(), gr.update())
+        # Clear msg, keep chatbot, stream audio_output, update 3 suggestion buttons
+        yield "", chat_history, audio_chunk, s1_update, s2_update, s3_update, messages
+
+# Combined function to process audio input, stream the response, generate audio/suggestions, and update UI
+async def process_audio_and_update(audio, chat_history, voice_enabled, messages):
+    if audio is None: # No audio input (also fired when the handler itself clears audio_input)
+        # Leave everything unchanged: the chat/messages inputs may be a stale mid-stream snapshot
+        yield None, gr.update(), gr.update(), gr.update(), gr.update(), gr.update(), gr.update()
+        return
+
+    # 1. Transcribe Audio (blocking API/local model call runs in a worker thread)
+    user_text = await asyncio.to_thread(transcribe_audio, audio)
 
     # Handle transcription error or empty transcription
     if not user_text or user_text.startswith("Error"):
         error_msg_display = user_text if user_text else "Audio could not be transcribed or was empty."
         chat_history.append(("(Audio input)", error_msg_display)) # Show indication of audio + error
         s1, s2, s3 = update_suggestions([])
-        # Return updates: clear audio_input, update chat, no audio output, clear suggestions
-        return None, chat_history, None, s1, s2, s3
+        # Yield updates: clear audio_input, update chat, no audio output, clear suggestions
+        yield None, chat_history, None, s1, s2, s3, messages
+        return
 
     # --- Proceed if transcription is successful ---
-    # 2. Get AI response
-    bot_message = ai_tutor(user_text, chat_history)
-    # 3. Update history (use transcribed text as user input)
-    chat_history.append((user_text, bot_message))
-    # 4. Generate audio (if enabled and no error)
-    audio_output_path = None
-    if voice_enabled and not bot_message.startswith("Error"):
-        audio_output_path = generate_speech(bot_message)
-    # 5. Generate suggestions
-    suggestions = generate_suggested_responses(bot_message)
-    # 6. Get suggestion button updates
-    s1_update, s2_update, s3_update = update_suggestions(suggestions)
-    # 7. Return all updates
-    #    Clear audio_input, update chat, update audio output, update suggestions
-    return None, chat_history, audio_output_path, s1_update, s2_update, s3_update
+    # 2. Add the transcribed turn and stream the AI response into it
+    chat_history.append((user_text, ""))
+    bot_message, suggestions = "", None
+    async for bot_message, suggestions in ai_tutor(user_text, messages):
+        chat_history[-1] = (user_text, bot_message)
+        yield None, chat_history, None, gr.update(), gr.update(), gr.update(), messages
+    # 3. Stream audio (if enabled and no error) and show suggestions
+    async for audio_chunk, suggestion_updates in speech_and_suggestions(bot_message, voice_enabled, suggestions):
+        s1_update, s2_update, s3_update = suggestion_updates or (gr.update(), gr.update(), gr.update())
+        # Clear audio_input, keep chat, stream audio output, update suggestions
+        yield None, chat_history, audio_chunk, s1_update, s2_update, s3_update, messages
 
 
 # Function to create and provide the study guide file (updated output handling)
-def create_and_download_study_guide(chat_history):
+# The blocking LLM call runs in a worker thread and PDF rendering in a worker process, so the event loop keeps serving other users
+async def create_and_download_study_guide(chat_history, session_files):
     if not chat_history:
         # Provide feedback via Markdown, hide File component
         return gr.File.update(value=None, visible=False), gr.Markdown.update(value="*Please have a conversation first.*")
 
     try:
-        study_guide_text = generate_study_guide_content(chat_history)
+        study_guide_text = await asyncio.to_thread(generate_study_guide_content, chat_history)
         if study_guide_text.startswith("Error"):
              return gr.File.update(value=None, visible=False), gr.Markdown.update(value=f"*Error generating content: {study_guide_text}*")
 
-        file_path, status_message = save_study_guide(study_guide_text)
+        file_path, status_message = await save_study_guide(study_guide_text, session_files)
 
         if file_path:
             # Provide file path and make File component visible, update status message
@@ -428,8 +794,8 @@ def create_and_download_study_guide(chat_history):
 
 # Clear chat and related UI elements (Updated outputs)
 def clear_chat():
-    # Return updates for: chatbot, audio_output, msg, suggestion buttons (x3), study_guide_download, study_guide_output(Markdown)
-    # Need 8 return values to match the 8 outputs in clear_btn.click
+    # Return updates for: chatbot, audio_output, msg, suggestion buttons (x3), study_guide_download, study_guide_output(Markdown), messages_state
+    # Need 9 return values to match the 9 outputs in clear_btn.click
     return (
         [],                      # chatbot history
         None,                    # audio_output value
@@ -438,7 +804,8 @@ def clear_chat():
         gr.Button(visible=False),# suggestion2
         gr.Button(visible=False),# suggestion3
         gr.File(value=None, visible=False), # study_guide_download
-        ""                       # study_guide_output (Markdown text)
+        "",                      # study_guide_output (Markdown text)
+        new_session_messages()   # messages_state
     )
 
 
@@ -463,6 +830,8 @@ with gr.Blocks(theme=black_orange_theme()) as demo: # Using your theme
     with gr.Row():
         with gr.Column(scale=3): # Left column for chat
             chatbot = gr.Chatbot(height=500, show_label=False) # Original parameters
+            # Session turn messages (the static system prompt is prepended per request), extended by one user/assistant pair per turn
+            messages_state = gr.State(new_session_messages())
 
             # Text input and buttons (Original structure)
             with gr.Row():
@@ -501,13 +870,14 @@ with gr.Blocks(theme=black_orange_theme()) as demo: # Using your theme
             gr.Markdown("### Voice Interaction")
             audio_input = gr.Audio(
                 sources=["microphone"],
-                type="filepath", # Keep this type
+                type="numpy", # Keep audio in memory, no temp file re-read
                 label="Voice Input", # Original label
             )
 
             audio_output = gr.Audio(
                 label="Voice Output", # Original label
-                autoplay=True, # Keep autoplay, output path will be None if disabled
+                streaming=True, # Play TTS chunks as they arrive
+                autoplay=True, # Keep autoplay, no audio is streamed if disabled
                 # Removed visible=True, default is usually True
             )
 
@@ -516,6 +886,8 @@ with gr.Blocks(theme=black_orange_theme()) as demo: # Using your theme
                 # Checkbox is now functional
                 voice_toggle = gr.Checkbox(label="Voice Output", value=True) # Original label/value
                 clear_btn = gr.Button("Clear Chat", variant="stop") # Original label/variant
+            # Speak the last reply on request, so TTS only runs on an explicit signal when voice output is off
+            play_btn = gr.Button("Play Last Reply")
 
             # Study Guide Section (Original structure)
             gr.Markdown("### Study Resources")
@@ -523,6 +895,8 @@ with gr.Blocks(theme=black_orange_theme()) as demo: # Using your theme
             # Markdown for status messages, File for download link
             study_guide_output = gr.Markdown("") # For status messages
             study_guide_download = gr.File(label="Download Study Guide", visible=False) # Start hidden
+            # Per-session study guide files ({suffix: path}), reused for every guide in the session
+            study_guide_files = gr.State({})
 
 
     # --- Event Listeners (Corrected Logic) ---
@@ -530,27 +904,33 @@ with gr.Blocks(theme=black_orange_theme()) as demo: # Using your theme
     # Text input processing (Enter key)
     msg.submit(
         process_text_and_update,
-        inputs=[msg, chatbot, voice_toggle],
-        # Outputs match the return values of process_text_and_update
-        outputs=[msg, chatbot, audio_output, suggestion1, suggestion2, suggestion3]
+        inputs=[msg, chatbot, voice_toggle, messages_state],
+        # Outputs match the values yielded by process_text_and_update (a streaming generator)
+        outputs=[msg, chatbot, audio_output, suggestion1, suggestion2, suggestion3, messages_state],
+        api_name=None
     )
 
     # Text input processing (Send button)
     submit_btn.click(
         process_text_and_update,
-        inputs=[msg, chatbot, voice_toggle],
-        outputs=[msg, chatbot, audio_output, suggestion1, suggestion2, suggestion3]
+        inputs=[msg, chatbot, voice_toggle, messages_state],
+        outputs=[msg, chatbot, audio_output, suggestion1, suggestion2, suggestion3, messages_state],
+        api_name=None
     )
 
     # Audio input processing (when recording finishes)
-    audio_input.change(
+    audio_event = audio_input.change(
         process_audio_and_update,
-        inputs=[audio_input, chatbot, voice_toggle],
-        # Outputs match the return values of process_audio_and_update
+        inputs=[audio_input, chatbot, voice_toggle, messages_state],
+        # Outputs match the values yielded by process_audio_and_update
         # Note: audio_input is cleared by returning None to it
-        outputs=[audio_input, chatbot, audio_output, suggestion1, suggestion2, suggestion3]
+        outputs=[audio_input, chatbot, audio_output, suggestion1, suggestion2, suggestion3, messages_state]
     )
 
+    # Starting a new recording cancels the in-flight transcription/LLM/TTS pipeline for the previous one
+    # (the handler is async, so cancellation lands at its next await)
+    audio_input.start_recording(fn=None, inputs=None, outputs=None, cancels=[audio_event])
+
     # Connect suggestion buttons to input box (Original logic was correct here)
     # Clicking a suggestion button calls use_suggestion with the button's value,
     # and the return value updates the 'msg' textbox.
@@ -558,10 +938,17 @@ with gr.Blocks(theme=black_orange_theme()) as demo: # Using your theme
     suggestion2.click(fn=use_suggestion, inputs=suggestion2, outputs=msg)
     suggestion3.click(fn=use_suggestion, inputs=suggestion3, outputs=msg)
 
+    # Play the last tutor reply (streams into the voice output)
+    play_btn.click(
+        play_last_reply,
+        inputs=[chatbot],
+        outputs=[audio_output]
+    )
+
     # Study guide generation
     study_guide_btn.click(
         create_and_download_study_guide,
-        inputs=[chatbot],
+        inputs=[chatbot, study_guide_files],
         # Outputs match the return values of create_and_download_study_guide
         outputs=[study_guide_download, study_guide_output] # File component and Markdown status
     )
@@ -571,9 +958,12 @@ with gr.Blocks(theme=black_orange_theme()) as demo: # Using your theme
         clear_chat,
         inputs=None,
         # List all components that clear_chat returns updates for
-        outputs=[chatbot, audio_output, msg, suggestion1, suggestion2, suggestion3, study_guide_download, study_guide_output],
+        outputs=[chatbot, audio_output, msg, suggestion1, suggestion2, suggestion3, study_guide_download, study_guide_output, messages_state],
         queue=False
     )
 
+# Allow up to 16 events to run at once; handlers are I/O-bound on OpenAI calls
+demo.queue(default_concurrency_limit=16)
+
 if __name__ == "__main__":
     demo.launch(share=False, debug=True) # Keep debug=True for testing
\ No newline at end of file